@@ -9,14 +9,45 @@
     :copyright: (c) 2011 by Armin Ronacher.
     :license: BSD, see LICENSE for more details.
 """
-import re
+import functools
+import io
+import sys
+try:
+    import re2 as re
+except ImportError:
+    import re
 from jinja2.ext import Extension
 from jinja2.lexer import Token, describe_token
 from jinja2 import TemplateSyntaxError
 
 
-_tag_re = re.compile(r'(?:<(/?)([a-zA-Z0-9_-]+)\s*|(>\s*))(?s)')
-_ws_normalize_re = re.compile(r'[ \t\r\n]+')
+_DEFAULT_ACTIVE_KEY = 'htmlcompress.default_active'
+
+# per-entry bits for the flags list that runs parallel to the tag stack
+_ISOLATED_FLAG = 1
+_HAS_RULES_FLAG = 2
+
+def _compile_patterns(engine):
+    # compiled through a helper so that an optional engine that cannot
+    # take one of the patterns drops us back to the stdlib wholesale
+    return (
+        engine.compile(r'(?:<(/?)([a-zA-Z0-9_-]+)\s*|(>\s*)|([ \t\r\n]+))'),
+        engine.compile(r'</?[a-zA-Z0-9_-]|>'),
+        engine.compile(r'[ \t\r\n]+'),
+        engine.compile(r'[\t\r\n]| {2,}|\A | $'),
+        engine.compile(r' {2,}'),
+    )
+
+
+try:
+    (_tag_re, _tag_start_re, _ws_normalize_re, _ws_dirty_re,
+     _multi_space_re) = _compile_patterns(re)
+except Exception:
+    import re
+    (_tag_re, _tag_start_re, _ws_normalize_re, _ws_dirty_re,
+     _multi_space_re) = _compile_patterns(re)
+
+_ws_translate = str.maketrans('\t\r\n', '   ')
 
 
 class StreamProcessContext(object):
@@ -25,99 +56,233 @@ class StreamProcessContext(object):
         self.stream = stream
         self.token = None
         self.stack = []
+        self.flags = []
+        self.positions = {}
+        self.isolated_depth = 0
 
     def fail(self, message):
         raise TemplateSyntaxError(message, self.token.lineno,
                                   self.stream.name, self.stream.filename)
 
 
+@functools.lru_cache(maxsize=1024)
+def _collapse_text(value):
+    # tag-free fragments repeat endlessly across templates sharing a
+    # layout (the '\n    ' between two blocks, say), so remember the
+    # collapsed form of the short ones
+    return _ws_normalize_re.sub(' ', value.strip(' \t\r\n'))
+
+
+@functools.lru_cache(maxsize=256)
+def _canonical_tag(tag):
+    # HTML tag names are case insensitive but the element tables are
+    # lowercase; templates reuse a handful of spellings, so lowercase
+    # and intern each one exactly once
+    return sys.intern(tag.lower())
+
+
+def _intern_frozenset(items):
+    # interned strings hash and compare by pointer, which makes the
+    # membership tests on the tag dispatch path as cheap as they get
+    return frozenset(sys.intern(item) for item in items)
+
+
 def _make_dict_from_listing(listing):
     rv = {}
     for keys, value in listing:
         for key in keys:
-            rv[key] = value
+            rv[sys.intern(key)] = _intern_frozenset(value)
+    return rv
+
+
+def _expand_breaking_rules(rules, block_elements):
+    # resolve the '#block' placeholder once so the rule sets only ever
+    # contain real tag names
+    rv = {}
+    for open_tag, breaking in rules.items():
+        if '#block' in breaking:
+            breaking = (breaking - frozenset(['#block'])) | block_elements
+        rv[open_tag] = frozenset(breaking)
     return rv
 
 
+def _make_breaking_pairs(rules):
+    # flatten the rules into a set of (tag, open_tag) pairs so
+    # is_breaking is one hash probe
+    pairs = set()
+    for open_tag, breaking in rules.items():
+        for tag in breaking:
+            pairs.add((tag, open_tag))
+    return frozenset(pairs)
+
+
 class HTMLCompress(Extension):
-    isolated_elements = set(['script', 'style', 'noscript', 'textarea'])
-    void_elements = set(['br', 'img', 'area', 'hr', 'param', 'input',
-                         'embed', 'col'])
-    block_elements = set(['div', 'p', 'form', 'ul', 'ol', 'li', 'table', 'tr',
-                          'tbody', 'thead', 'tfoot', 'tr', 'td', 'th', 'dl',
-                          'dt', 'dd', 'blockquote', 'h1', 'h2', 'h3', 'h4',
-                          'h5', 'h6', 'pre'])
-    breaking_rules = _make_dict_from_listing([
+    default_active = True
+    isolated_elements = _intern_frozenset(['script', 'style', 'noscript',
+                                           'textarea'])
+    void_elements = _intern_frozenset(['br', 'img', 'area', 'hr', 'param',
+                                       'input', 'embed', 'col'])
+    block_elements = _intern_frozenset(['div', 'p', 'form', 'ul', 'ol', 'li',
+                                        'table', 'tr', 'tbody', 'thead',
+                                        'tfoot', 'tr', 'td', 'th', 'dl', 'dt',
+                                        'dd', 'blockquote', 'h1', 'h2', 'h3',
+                                        'h4', 'h5', 'h6', 'pre'])
+    breaking_rules = _expand_breaking_rules(_make_dict_from_listing([
         (['p'], set(['#block'])),
         (['li'], set(['li'])),
         (['td', 'th'], set(['td', 'th', 'tr', 'tbody', 'thead', 'tfoot'])),
         (['tr'], set(['tr', 'tbody', 'thead', 'tfoot'])),
         (['thead', 'tbody', 'tfoot'], set(['thead', 'tbody', 'tfoot'])),
         (['dd', 'dt'], set(['dl', 'dt', 'dd']))
-    ])
+    ]), block_elements)
+    breaking_pairs = _make_breaking_pairs(breaking_rules)
 
-    def is_isolated(self, stack):
-        for tag in reversed(stack):
-            if tag in self.isolated_elements:
-                return True
-        return False
+    def __init__(self, environment):
+        Extension.__init__(self, environment)
+        self._active = None
+
+    def active_for_stream(self):
+        """Checks the ``htmlcompress.default_active`` policy of the
+        environment.  Extension instances are per environment, so the
+        result is computed once and cached on the instance.
+        """
+        if self._active is None:
+            self._active = self.environment.policies.get(
+                _DEFAULT_ACTIVE_KEY, self.default_active)
+        return self._active
+
+    def is_isolated(self, ctx):
+        return ctx.isolated_depth > 0
 
     def is_breaking(self, tag, other_tag):
-        breaking = self.breaking_rules.get(other_tag)
-        return breaking and (tag in breaking or
-            ('#block' in breaking and tag in self.block_elements))
+        return (tag, other_tag) in self.breaking_pairs
 
     def enter_tag(self, tag, ctx):
         while ctx.stack and self.is_breaking(tag, ctx.stack[-1]):
             self.leave_tag(ctx.stack[-1], ctx)
         if tag not in self.void_elements:
+            flag = 0
+            if tag in self.isolated_elements:
+                flag = _ISOLATED_FLAG
+                ctx.isolated_depth += 1
+            if tag in self.breaking_rules:
+                flag |= _HAS_RULES_FLAG
+            ctx.positions.setdefault(tag, []).append(len(ctx.stack))
             ctx.stack.append(tag)
+            ctx.flags.append(flag)
+
+    def _pop_tag(self, ctx):
+        tag = ctx.stack.pop()
+        ctx.positions[tag].pop()
+        if ctx.flags.pop() & _ISOLATED_FLAG:
+            ctx.isolated_depth -= 1
 
     def leave_tag(self, tag, ctx):
-        if not ctx.stack:
+        stack = ctx.stack
+        if not stack:
             ctx.fail('Tried to leave "%s" but something closed '
                      'it already' % tag)
-        if tag == ctx.stack[-1]:
-            ctx.stack.pop()
+        if tag == stack[-1]:
+            self._pop_tag(ctx)
+            return
+        # jump straight to the topmost open occurrence instead of
+        # scanning the whole stack for tags that are not open at all
+        positions = ctx.positions.get(tag)
+        if not positions:
             return
-        for idx, other_tag in enumerate(reversed(ctx.stack)):
-            if other_tag == tag:
-                for num in xrange(idx + 1):
-                    ctx.stack.pop()
-            elif not self.breaking_rules.get(other_tag):
-                break
+        idx = positions[-1]
+        # everything above the match must allow an implicit close
+        flags = ctx.flags
+        for i in range(len(stack) - 1, idx, -1):
+            if not flags[i] & _HAS_RULES_FLAG:
+                return
+        ctx_positions = ctx.positions
+        for i in range(idx, len(stack)):
+            ctx_positions[stack[i]].pop()
+            if flags[i] & _ISOLATED_FLAG:
+                ctx.isolated_depth -= 1
+        del stack[idx:]
+        del flags[idx:]
 
     def normalize(self, ctx):
+        value = ctx.token.value
+        # text without any tag markers needs no scanner walk: it either
+        # passes through verbatim (isolated) or collapses in one sub()
+        if '<' not in value and '>' not in value:
+            if ctx.isolated_depth:
+                return value
+            if len(value) < 256:
+                return _collapse_text(value)
+            value = value.strip(' \t\r\n')
+            # canonicalize the rare characters in one table-driven pass,
+            # then only pay for the sub when a run can actually collapse
+            if '\t' in value or '\n' in value or '\r' in value:
+                value = value.translate(_ws_translate)
+            if '  ' in value:
+                value = _multi_space_re.sub(' ', value)
+            return value
         pos = 0
-        buffer = []
-        def write_data(value):
-            if not self.is_isolated(ctx.stack):
-                value = _ws_normalize_re.sub(' ', value.strip())
-            buffer.append(value)
-
-        for match in _tag_re.finditer(ctx.token.value):
-            closes, tag, sole = match.groups()
-            preamble = ctx.token.value[pos:match.start()]
-            write_data(preamble)
-            if sole:
-                write_data(sole)
+        buffer = io.StringIO()
+        length = len(value)
+        write = buffer.write
+        enter_tag = self.enter_tag
+        leave_tag = self.leave_tag
+        tag_starts = _tag_start_re.match
+        canonical = _canonical_tag
+
+        def substitute(match):
+            nonlocal pos
+            start = match.start()
+            end = match.end()
+            write(value[pos:start])
+            # lastindex tells which alternative fired without building
+            # the groups tuple: 4 = whitespace run, 3 = stray '>',
+            # otherwise 1/2 = tag
+            group = match.lastindex
+            if group == 4:
+                if ctx.isolated_depth:
+                    write(match.group())
+                elif start != pos and end != length and \
+                        not tag_starts(value, end):
+                    # whitespace inside text collapses to a single space,
+                    # whitespace next to a tag or the token edges vanishes
+                    write(' ')
+            elif group == 3:
+                write(match.group() if ctx.isolated_depth else '>')
             else:
-                buffer.append(match.group())
-                (closes and self.leave_tag or self.enter_tag)(tag, ctx)
-            pos = match.end()
+                write(match.group())
+                (leave_tag if match.group(1) else enter_tag)(
+                    canonical(match.group(2)), ctx)
+            pos = end
+            return ''
 
-        write_data(ctx.token.value[pos:])
-        return u''.join(buffer)
+        _tag_re.sub(substitute, value)
+        write(value[pos:])
+        return buffer.getvalue()
 
     def filter_stream(self, stream):
+        if not self.active_for_stream():
+            yield from stream
+            return
         ctx = StreamProcessContext(stream)
         for token in stream:
             if token.type != 'data':
                 yield token
                 continue
+            # tokens without tag markers whose whitespace is nothing but
+            # lone interior spaces cannot change, so don't even enter
+            # the scanner for them
+            old_value = token.value
+            if '<' not in old_value and '>' not in old_value and \
+               not _ws_dirty_re.search(old_value):
+                yield token
+                continue
             ctx.token = token
             value = self.normalize(ctx)
-            yield Token(token.lineno, 'data', value)
+            if value is old_value or value == old_value:
+                yield token
+            else:
+                yield Token(token.lineno, 'data', value)
 
 
 class SelectiveHTMLCompress(HTMLCompress):
@@ -126,9 +291,17 @@ class SelectiveHTMLCompress(HTMLCompress):
         ctx = StreamProcessContext(stream)
         strip_depth = 0
         while 1:
+            if not strip_depth and stream.current.type == 'data':
+                # outside strip blocks data passes through untouched, so
+                # drain it without re-checking the block machinery
+                while stream.current.type == 'data':
+                    yield stream.current
+                    next(stream)
+                continue
             if stream.current.type == 'block_begin':
-                if stream.look().test('name:strip') or \
-                   stream.look().test('name:endstrip'):
+                peek_next = stream.look()
+                if peek_next.test('name:strip') or \
+                   peek_next.test('name:endstrip'):
                     stream.skip()
                     if stream.current.value == 'strip':
                         strip_depth += 1
@@ -141,19 +314,40 @@ class SelectiveHTMLCompress(HTMLCompress):
                         ctx.fail('expected end of block, got %s' %
                                  describe_token(stream.current))
                     stream.skip()
-            if strip_depth > 0 and stream.current.type == 'data':
-                ctx.token = stream.current
+            token = stream.current
+            if strip_depth > 0 and token.type == 'data':
+                ctx.token = token
                 value = self.normalize(ctx)
-                yield Token(stream.current.lineno, 'data', value)
+                if value is token.value or value == token.value:
+                    yield token
+                else:
+                    yield Token(token.lineno, 'data', value)
             else:
-                yield stream.current
-            stream.next()
+                yield token
+            next(stream)
 
 
-def test():
+_demo_envs = {}
+_demo_renderers = {}
+
+
+def _demo_render(compressor, source, **context):
+    """Renders one of the demo templates below, reusing one environment
+    per extension class and compiling each source string only once.
+    """
     from jinja2 import Environment
-    env = Environment(extensions=[HTMLCompress])
-    tmpl = env.from_string('''
+    render = _demo_renderers.get((compressor, source))
+    if render is None:
+        env = _demo_envs.get(compressor)
+        if env is None:
+            env = _demo_envs[compressor] = Environment(
+                extensions=[compressor], auto_reload=False, cache_size=-1)
+        render = _demo_renderers[compressor, source] = \
+            env.from_string(source).render
+    return render(**context)
+
+
+_DEMO_SOURCE = '''
         <html>
           <head>
             <title>{{ title }}</title>
@@ -168,11 +362,9 @@ def test():
             <li><a href="{{ href }}">{{ title }}</a><img src=test.png>
           </body>
         </html>
-    ''')
-    print tmpl.render(title=42, href='index.html')
+    '''
 
-    env = Environment(extensions=[SelectiveHTMLCompress])
-    tmpl = env.from_string('''
+_SELECTIVE_DEMO_SOURCE = '''
         Normal   <span>  unchanged </span> stuff
         {% strip %}Stripped <span class=foo  >   test   </span>
         <a href="foo">  test </a> {{ foo }}
@@ -184,8 +376,17 @@ def test():
           Moep    <span>Test</span>    Moep
         </p>
         {% endstrip %}
-    ''')
-    print tmpl.render(foo=42)
+    '''
+
+_DEMO_CASES = [
+    (HTMLCompress, _DEMO_SOURCE, {'title': 42, 'href': 'index.html'}),
+    (SelectiveHTMLCompress, _SELECTIVE_DEMO_SOURCE, {'foo': 42}),
+]
+
+
+def test():
+    for compressor, source, context in _DEMO_CASES:
+        print(_demo_render(compressor, source, **context))
 
 
 if __name__ == '__main__':